@@ -6,6 +6,13 @@ import scheduler as s
 
 
 class TestUtilityFunctions(unittest.TestCase):
+    def test_tags_are_bad(self):
+        self.assertEqual(s.tags_are_bad([]), False)
+        self.assertEqual(s.tags_are_bad(["home", "dsl"]), False)
+        self.assertEqual(s.tags_are_bad(["home", "ixp"]), True)
+        self.assertEqual(s.tags_are_bad(["datacenter"]), True)
+        self.assertEqual(s.tags_are_bad(["home", "data-center-1"]), True)
+
     def test_ready_for_measurement(self):
         self.assertEqual(s.ready_for_measurement(dt.time(hour=0)), True)
         self.assertEqual(s.ready_for_measurement(dt.time(second=59)), True)
@@ -13,10 +20,14 @@ class TestUtilityFunctions(unittest.TestCase):
             s.ready_for_measurement(dt.time(hour=20, minute=59, second=5)), True
         )
         self.assertEqual(s.ready_for_measurement(dt.time(hour=21, second=20)), True)
+        self.assertEqual(
+            s.ready_for_measurement(dt.time(hour=23, minute=59, second=30)), True
+        )
 
         self.assertEqual(s.ready_for_measurement(dt.time(minute=1)), False)
         self.assertEqual(s.ready_for_measurement(dt.time(hour=1)), False)
         self.assertEqual(s.ready_for_measurement(dt.time(hour=20, minute=58)), False)
+        self.assertEqual(s.ready_for_measurement(dt.time(hour=23, minute=59)), False)
 
 
 if __name__ == "__main__":
@@ -4,16 +4,25 @@ import sys
 import json
 import time
 import os
+import subprocess
 import ipaddress
 import pathlib
 import logging as log
 import datetime as dt
+import concurrent.futures as cf
+import functools
 import zoneinfo as zi
+from operator import itemgetter
 from typing import Callable, Any
 
 import ripe.atlas.cousteau as atlas
 from timezonefinder import TimezoneFinder
 
+try:
+    import orjson  # Optional, but parses large probe files faster than json.
+except ImportError:
+    orjson = None
+
 log.basicConfig(
     format="%(asctime)s %(levelname)s: %(message)s",
     level=log.INFO,
@@ -31,116 +40,136 @@ V4_TARGET = ""
 V6_TARGET = ""
 API_KEY = ""  # TODO
 GRACE_PERIOD = 60
+BATCH_SIZE = 50
+MAX_CONCURRENT_BATCHES = 8
+MAX_CONCURRENT_TRACEROUTES = 64
+TRACEROUTE_DIR = "tr"  # Directory where traceroute data is stored in.
 CC_LEN = 2  # Length of the ISO 3166 country code.
 IPV4_ADDR = "address_v4"
 IPV6_ADDR = "address_v6"
-BAD_TAGS = [
-    "system-geoloc-disputed",
-    "core",
-    "cloud",
-    "vps",
-    "ixp",
-]
-GOOD_TAGS = [
-    "deutsche-glasfaser",
-    "dn42",
-    "fiona",
-    "freedom-internet",
-    "fttb",
-    "fttp",
-    "gpnrp",
-    "hybrid",
-    "makerspace",
-    "mesh",
-    "openfiber",
-    "pon",
-    "ukraine",
-    "verizon",
-    "virgin-media",
-    "6in4",
-    "fiber",
-    "frontier",
-    "lxc",
-    "swisscom",
-    "bell",
-    "cox-3",
-    "fttp-2",
-    "container",
-    "fbnh",
-    "fttb-2",
-    "464xlat",
-    "system-wifi",
-    "telenet",
-    "sixxs",
-    "google-fiber",
-    "system-flakey-power",
-    "o2",
-    "system-flakey-connection",
-    "xfinity",
-    "freifunk",
-    "no-ipv4",
-    "xs4all",
-    "t-mobile",
-    "kpn",
-    "5g",
-    "sfr",
-    "ipv6nat",
-    "spectrum",
-    "att",
-    "nat64",
-    "wimax",
-    "epix",
-    "ipv6-only",
-    "v5hitron",
-    "starlink",
-    "fttc",
-    "twc",
-    "3g",
-    "6rd",
-    "telekom",
-    "system-resolves-aaaa-incorrectly",
-    "known-ipv4-issues",
-    "satellite",
-    "vodafone",
-    "ziggo",
-    "docsis-31",
-    "openwrt-3",
-    "ds-lite",
-    "6to4",
-    "pi-hole",
-    "nosi",
-    "fios",
-    "hackerspace",
-    "upc",
-    "pppoe",
-    "vpn",
-    "wi-fi",
-    "docker",
-    "he",
-    "gpon",
-    "homelab",
-    "orange",
-    "4g",
-    "comcast",
-    "cgn",
-    "dtag",
-    "mobile",
-    "lte",
-    "double-nat",
-    "wireless-isp",
-    "adsl",
-    "docsis3",
-    "ipv6-tunnel",
-    "vdsl",
-    "vdsl2",
-    "ftth",
-    "office",
-    "dsl",
-    "cable",
-    "home",
-    "nat",
-]
-BAD_STATUS_NAMES = ["Disconnected", "Abandoned"]
+# The only probe fields that we use.
+PROBE_FIELDS = (
+    ID,
+    COUNTRY_CODE,
+    TAGS,
+    STATUS,
+    LATITUDE,
+    LONGITUDE,
+    IPV4_ADDR,
+    IPV6_ADDR,
+)
+BAD_TAGS = frozenset(
+    [
+        "system-geoloc-disputed",
+        "core",
+        "cloud",
+        "vps",
+        "ixp",
+    ]
+)
+BAD_TAG_PREFIXES = ("data-center", "datacenter")
+GOOD_TAGS = frozenset(
+    [
+        "deutsche-glasfaser",
+        "dn42",
+        "fiona",
+        "freedom-internet",
+        "fttb",
+        "fttp",
+        "gpnrp",
+        "hybrid",
+        "makerspace",
+        "mesh",
+        "openfiber",
+        "pon",
+        "ukraine",
+        "verizon",
+        "virgin-media",
+        "6in4",
+        "fiber",
+        "frontier",
+        "lxc",
+        "swisscom",
+        "bell",
+        "cox-3",
+        "fttp-2",
+        "container",
+        "fbnh",
+        "fttb-2",
+        "464xlat",
+        "system-wifi",
+        "telenet",
+        "sixxs",
+        "google-fiber",
+        "system-flakey-power",
+        "o2",
+        "system-flakey-connection",
+        "xfinity",
+        "freifunk",
+        "no-ipv4",
+        "xs4all",
+        "t-mobile",
+        "kpn",
+        "5g",
+        "sfr",
+        "ipv6nat",
+        "spectrum",
+        "att",
+        "nat64",
+        "wimax",
+        "epix",
+        "ipv6-only",
+        "v5hitron",
+        "starlink",
+        "fttc",
+        "twc",
+        "3g",
+        "6rd",
+        "telekom",
+        "system-resolves-aaaa-incorrectly",
+        "known-ipv4-issues",
+        "satellite",
+        "vodafone",
+        "ziggo",
+        "docsis-31",
+        "openwrt-3",
+        "ds-lite",
+        "6to4",
+        "pi-hole",
+        "nosi",
+        "fios",
+        "hackerspace",
+        "upc",
+        "pppoe",
+        "vpn",
+        "wi-fi",
+        "docker",
+        "he",
+        "gpon",
+        "homelab",
+        "orange",
+        "4g",
+        "comcast",
+        "cgn",
+        "dtag",
+        "mobile",
+        "lte",
+        "double-nat",
+        "wireless-isp",
+        "adsl",
+        "docsis3",
+        "ipv6-tunnel",
+        "vdsl",
+        "vdsl2",
+        "ftth",
+        "office",
+        "dsl",
+        "cable",
+        "home",
+        "nat",
+    ]
+)
+BAD_STATUS_NAMES = frozenset(["Disconnected", "Abandoned"])
 MEASUREMENT_TIMES = [
     dt.time(hour=0),
     dt.time(hour=3),
@@ -151,19 +180,21 @@ MEASUREMENT_TIMES = [
     dt.time(hour=18),
     dt.time(hour=21),
 ]
+SECS_PER_DAY = 24 * 60 * 60
 TZFinder = TimezoneFinder()
+TraceroutePool = cf.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TRACEROUTES)
 
 
 def tags_are_bad(tags: list[str]) -> bool:
     """Return True if any of the probe's tags violate our selection criteria."""
+    bad_tags, bad_prefixes = BAD_TAGS, BAD_TAG_PREFIXES
     for tag in tags:
-        if tag in BAD_TAGS:
-            return True
-        if tag.startswith("data-center") or tag.startswith("datacenter"):
+        if tag in bad_tags or tag.startswith(bad_prefixes):
             return True
     return False
 
 
+@functools.cache
 def lat_lon_to_timezone(lat: float, lon: float) -> zi.ZoneInfo:
     """Convert a lat/lon pair to a time zone object (e.g., Europe/Berlin)."""
     assert lat != 0 and lon != 0
@@ -184,15 +215,22 @@ def pct(numerator: int, denominator: int) -> float:
     return numerator / denominator * 100
 
 
+def secs_since_midnight(t: dt.time) -> int:
+    """Return the number of whole seconds between midnight and the given time."""
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+MEASUREMENT_SECS = tuple(secs_since_midnight(t) for t in MEASUREMENT_TIMES)
+
+
 def ready_for_measurement(t1: dt.time) -> bool:
     """Return True if the given time is close to a 'measurement time'."""
-    today = dt.date.today()
-    for t2 in MEASUREMENT_TIMES:
-        dt1 = dt.datetime.combine(today, t1)
-        dt2 = dt.datetime.combine(today, t2)
-        diff = abs(dt1 - dt2)
-        # Are we within a minute of a "measurement time"?
-        if diff.total_seconds() < GRACE_PERIOD:
+    s1 = secs_since_midnight(t1)
+    for s2 in MEASUREMENT_SECS:
+        diff = abs(s1 - s2)
+        # Are we within a minute of a "measurement time"?  The second check
+        # covers times just before midnight.
+        if diff < GRACE_PERIOD or diff > SECS_PER_DAY - GRACE_PERIOD:
             return True
     return False
 
@@ -201,11 +239,21 @@ def filter_by_time(all_probes: list[dict]) -> list[dict]:
     log.info("Filtering probes by time.")
     subset_probes = []
     num_not_time = 0
+    # Evaluate every probe at the same instant, so that the result does not
+    # depend on how long the loop takes.
+    now = dt.datetime.now(tz=dt.timezone.utc)
+    # Many probes share a time zone, so only check each time zone once.
+    ready_by_tz = {}
+    # This loop runs every round, so avoid global lookups inside of it.
+    lat, lon, to_timezone = LATITUDE, LONGITUDE, lat_lon_to_timezone
     for probe in all_probes:
         # Determine probe's local time from its lat/lon pair.
-        probe_tz = lat_lon_to_timezone(probe[LATITUDE], probe[LONGITUDE])
-        probe_time = dt.datetime.now(tz=probe_tz)
-        if ready_for_measurement(probe_time.time()):
+        probe_tz = to_timezone(probe[lat], probe[lon])
+        ready = ready_by_tz.get(probe_tz)
+        if ready is None:
+            probe_time = now.astimezone(probe_tz)
+            ready = ready_by_tz[probe_tz] = ready_for_measurement(probe_time.time())
+        if ready:
             subset_probes.append(probe)
         else:
             num_not_time += 1
@@ -242,7 +290,7 @@ def filter_by_eligibility(all_probes: list[dict]) -> list[dict]:
         if probe[IPV4_ADDR] is None and probe[IPV6_ADDR] is None:
             num_addrless += 1
             continue
-        if any([t in GOOD_TAGS for t in probe[TAGS]]):
+        if not GOOD_TAGS.isdisjoint(probe[TAGS]):
             subset_probes.append(probe)
 
     num_probes = len(all_probes)
@@ -277,13 +325,30 @@ def load_probes(probe_file: str) -> list[dict]:
     """Load the probes from the given JSON file."""
     log.info("Reading {}.".format(probe_file))
 
-    with open(probe_file, "r") as f:
-        records = json.load(f)
-    return records[OBJECTS]
+    with open(probe_file, "rb") as f:
+        data = f.read()
+    records = orjson.loads(data) if orjson is not None else json.loads(data)
+    # Drop the fields that we don't need because we hold on to the probes for
+    # the entire run.
+    return [{k: p[k] for k in PROBE_FIELDS} for p in records[OBJECTS]]
+
+
+def traceroute(target: str, ip_version: int):
+    """Run an ICMP traceroute to the given target and wait for it to finish."""
+    file_name = os.path.join(TRACEROUTE_DIR, target)
+    log_file, err_file = file_name + ".log", file_name + ".err"
+    cmd = ["traceroute", "-{}".format(ip_version), "--icmp", "-n", target]
+    try:
+        with open(log_file, "wb") as out, open(err_file, "wb") as err:
+            subprocess.run(cmd, stdout=out, stderr=err)
+    except OSError as err:
+        log.error("Error running traceroute to {}: {}".format(target, err))
 
 
 def run_icmp_traceroute(target: str):
     """Run an ICMP traceroute to the given target and save the result in a file."""
+    # Parsing the address also makes sure that we never pass anything but an IP
+    # address to traceroute.
     try:
         ip_version = ipaddress.ip_address(target).version
     except ValueError as err:
@@ -291,13 +356,9 @@ def run_icmp_traceroute(target: str):
         return
     assert ip_version in [4, 6]
 
-    dir = "tr"  # Directory where traceroute data is stored in.
-    pathlib.Path(dir).mkdir(parents=True, exist_ok=True)
-    file_name = os.path.join(dir, target)
-    cmd = "traceroute -{} --icmp -n {} > {}.log 2>{}.err &".format(
-        ip_version, target, file_name, file_name
-    )
-    os.system(cmd)
+    # The pool runs at most MAX_CONCURRENT_TRACEROUTES traceroutes at a time and
+    # queues the rest.
+    TraceroutePool.submit(traceroute, target, ip_version)
 
 
 def create_measurements(target: str, ip_version: int) -> list[atlas.AtlasMeasurement]:
@@ -329,23 +390,24 @@ def create_measurements(target: str, ip_version: int) -> list[atlas.AtlasMeasure
     ]
 
 
-def schedule_measurements(probes: list[dict]):
+# Our measurements are the same for every batch of probes.
+MEASUREMENTS = create_measurements(V4_TARGET, 4) + create_measurements(V6_TARGET, 6)
+
+
+def schedule_measurements(probes: list[dict], start_time: dt.datetime):
     """Schedule RIPE Atlas measurements for the given probes."""
     assert len(probes) > 0
 
     probe_ids = ",".join([str(p[ID]) for p in probes])
 
-    v4_measurements = create_measurements(V4_TARGET, 4)
-    v6_measurements = create_measurements(V6_TARGET, 6)
-
     source = atlas.AtlasChangeSource(
-        value=probe_ids, requested=len(probe_ids), type="probes", action="add"
+        value=probe_ids, requested=len(probes), type="probes", action="add"
     )
 
     atlas_request = atlas.AtlasCreateRequest(
-        start_time=dt.datetime.utcnow(),
+        start_time=start_time,
         key=API_KEY,
-        measurements=v4_measurements + v6_measurements,
+        measurements=MEASUREMENTS,
         sources=[source],
         is_oneoff=True,
     )
@@ -366,34 +428,43 @@ def schedule_measurements(probes: list[dict]):
 
 def print_probes(our_probes: list[dict]):
     """Print CSV data, with one ID,addr pair per line."""
-    probe_by_id = {p[ID]: p for p in our_probes}
-    for id in sorted(probe_by_id.keys()):
-        probe = probe_by_id[id]
+    lines = []
+    for probe in sorted(our_probes, key=itemgetter(ID)):
         addr = probe[IPV4_ADDR]
         if addr is None:  # Probe may only be reachable via IPv6.
             addr = probe[IPV6_ADDR]
             assert addr is not None, probe
-        print("{},{}".format(id, addr))
+        lines.append("{},{}\n".format(probe[ID], addr))
+    sys.stdout.write("".join(lines))
 
 
-def sleep_until(datetime: dt.datetime):
+def sleep_until(target: dt.datetime):
     """Suspend execution until the given date/time."""
-    diff = datetime - datetime.now(tz=datetime.tzinfo)
-    num_secs = diff.total_seconds()
-    log.info("Sleeping {} until {}.".format(diff, datetime))
-    time.sleep(num_secs)
+    diff = target - dt.datetime.now(tz=target.tzinfo)
+    num_secs = max(0.0, diff.total_seconds())
+    log.info("Sleeping {} until {}.".format(diff, target))
+    # Use the monotonic clock, so that wall clock adjustments while we sleep
+    # don't shift the deadline.
+    deadline = time.monotonic() + num_secs
+    while (remaining := deadline - time.monotonic()) > 0:
+        time.sleep(min(remaining, 60))
 
 
 def run_in_batches(probes: list[dict], func: Callable[[list], Any]):
-    """Process the given list of probes one batch at a time."""
-    batch_size = 50
-    for i in range(0, len(probes), batch_size):
-        func(probes[i : i + batch_size])
+    """Process the given list of probes in concurrent batches."""
+    batches = [probes[i : i + BATCH_SIZE] for i in range(0, len(probes), BATCH_SIZE)]
+    # Processing a batch mostly means waiting for the Atlas API to respond.
+    with cf.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES) as pool:
+        for _ in pool.map(func, batches):
+            pass  # Surface exceptions raised in worker threads.
 
 
 def main(probe_file: str, start_date: dt.datetime):
     """The entry point of this script."""
+    pathlib.Path(TRACEROUTE_DIR).mkdir(parents=True, exist_ok=True)
     all_probes = load_probes(probe_file)
+    # A probe's eligibility does not change over the course of a run.
+    eligible_probes = filter_by_eligibility(all_probes)
 
     # Begin a set of measurements lasting 50 hours.
     # We need to cover the Eastern-most time zone (UTC+14) to the Western-most
@@ -408,7 +479,7 @@ def main(probe_file: str, start_date: dt.datetime):
             )
         )
 
-        current_probes = filter_by_time(filter_by_eligibility(all_probes))
+        current_probes = filter_by_time(eligible_probes)
         if len(current_probes) > 0:
             log.info("Proceeding with {:,} probes.".format(len(current_probes)))
             # We repeat each measurement round three times, five minutes apart.
@@ -417,13 +488,20 @@ def main(probe_file: str, start_date: dt.datetime):
                 log.info(
                     "Starting measurement run {}/{}.".format(repeat + 1, num_repeats)
                 )
-                run_in_batches(current_probes, schedule_measurements)
+                # All batches of a measurement run share the same start time.
+                start_time = dt.datetime.now(tz=dt.timezone.utc)
+                run_in_batches(
+                    current_probes,
+                    functools.partial(schedule_measurements, start_time=start_time),
+                )
                 time.sleep(60 * 5)
         else:
             log.info("No probes meant to run measurements.")
 
         log.info("Done with current hour.")
 
+    log.info("Waiting for remaining traceroutes to finish.")
+    TraceroutePool.shutdown(wait=True)
     log.info("Done with measurements.")
 
 